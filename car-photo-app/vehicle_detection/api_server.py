@@ -4,16 +4,18 @@ FastAPI server for vehicle damage detection
 Provides REST API endpoint for the React Native app
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
+import asyncio
 import cv2
 import numpy as np
-import io
-from PIL import Image
 import json
-import tempfile
-from pathlib import Path
+import base64
+import uuid
+import orjson
 
 # Import our damage detector
 from inference import DamageDetector
@@ -21,7 +23,8 @@ from inference import DamageDetector
 app = FastAPI(
     title="Vehicle Damage Detection API",
     description="API for detecting vehicle damage using YOLOv8",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # C-accelerated JSON serialization
 )
 
 # Enable CORS for React Native app
@@ -33,8 +36,102 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize damage detector
-detector = DamageDetector()
+# Initialize damage detector with a dynamic-batch FP16 TensorRT engine (on GPU)
+MAX_BATCH = 8
+detector = DamageDetector(max_batch=MAX_BATCH, int8=False)
+
+class MicroBatcher:
+    """
+    Collects concurrent detection requests into a single model call
+    A batch is dispatched once max_batch requests are queued or max_wait
+    seconds after the first one arrived, whichever comes first
+    """
+    
+    def __init__(self, detector, max_batch=8, max_wait=0.008):
+        self.detector = detector
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self.task = None
+    
+    def start(self):
+        """Start the background batching loop on the running event loop"""
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        """Cancel the batching loop"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+    
+    async def detect(self, image, confidence):
+        """Queue an image for detection and wait for its damages"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, confidence, future))
+        return await future
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            images, confidences, futures = zip(*batch)
+            try:
+                results = await run_in_threadpool(
+                    self.detector.detect_damage_batch, list(images), list(confidences))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            # Demultiplex the batch back to the waiting requests
+            for i, future in enumerate(futures):
+                if not future.done():
+                    future.set_result(None if results is None else results[i])
+
+batcher = MicroBatcher(detector, max_batch=MAX_BATCH)
+
+def decode_image(contents):
+    """Decode uploaded image bytes straight to a BGR array (None if invalid)"""
+    buffer = np.frombuffer(contents, dtype=np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+def encode_annotated_image(image_array, damages):
+    """Draw detections on the image and return it as JPEG bytes"""
+    annotated_image = detector.visualize_detections(image_array, damages)
+    _, buffer = cv2.imencode('.jpg', annotated_image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return buffer.tobytes()
+
+def multipart_response(report, jpeg_bytes):
+    """
+    Build a multipart/mixed response: JSON report part + raw JPEG part
+    Avoids the base64 inflation and decode cost of embedding the image in JSON
+    """
+    boundary = uuid.uuid4().hex
+    parts = [
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode(),
+        orjson.dumps(report, option=orjson.OPT_NON_STR_KEYS),
+        (f"\r\n--{boundary}\r\nContent-Type: image/jpeg\r\n"
+         f"Content-Disposition: attachment; filename=\"annotated.jpg\"\r\n\r\n").encode(),
+        jpeg_bytes,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ]
+    return StreamingResponse(iter(parts), media_type=f"multipart/mixed; boundary={boundary}")
 
 @app.on_event("startup")
 async def startup_event():
@@ -43,7 +140,15 @@ async def startup_event():
     if not success:
         print("❌ Failed to load damage detection model")
     else:
+        await run_in_threadpool(detector.warmup)
         print("✅ Damage detection model loaded successfully")
+    
+    batcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the request batching loop"""
+    await batcher.stop()
 
 @app.get("/")
 async def root():
@@ -77,98 +182,83 @@ async def detect_damage(
         # Read image data
         contents = await file.read()
         
-        # Convert to OpenCV format
-        image = Image.open(io.BytesIO(contents))
-        image_array = np.array(image)
+        # Decode to OpenCV BGR format (CPU-bound work runs off the event loop)
+        image_array = await run_in_threadpool(decode_image, contents)
+        if image_array is None:
+            raise HTTPException(status_code=400, detail="Could not decode image")
         
-        # Convert RGB to BGR for OpenCV
-        if len(image_array.shape) == 3:
-            image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+        # Run damage detection on the in-memory image
+        damages = await batcher.detect(image_array, confidence)
         
-        # Save temporary file for processing
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-            cv2.imwrite(tmp_file.name, image_array)
-            temp_path = tmp_file.name
+        if damages is None:
+            raise HTTPException(status_code=500, detail="Damage detection failed")
         
-        try:
-            # Run damage detection
-            damages = detector.detect_damage(temp_path, confidence)
-            
-            if damages is None:
-                raise HTTPException(status_code=500, detail="Damage detection failed")
-            
-            # Generate comprehensive report
-            report = detector.generate_report(damages, file.filename)
-            
-            # Add API metadata
-            api_response = {
-                "success": True,
-                "filename": file.filename,
-                "confidence_threshold": confidence,
-                "processing_time": "< 1s",  # You can add actual timing
-                "api_version": "1.0.0",
-                **report
-            }
-            
-            return api_response
-            
-        finally:
-            # Clean up temporary file
-            Path(temp_path).unlink(missing_ok=True)
+        # Generate comprehensive report
+        report = detector.generate_report(damages, file.filename)
+        
+        # Add API metadata
+        api_response = {
+            "success": True,
+            "filename": file.filename,
+            "confidence_threshold": confidence,
+            "processing_time": "< 1s",  # You can add actual timing
+            "api_version": "1.0.0",
+            **report
+        }
+        
+        return api_response
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
 @app.post("/detect-damage-with-image")
 async def detect_damage_with_annotated_image(
     file: UploadFile = File(...),
-    confidence: float = 0.5
+    confidence: float = 0.5,
+    accept: str = Header(default="application/json")
 ):
     """
     Detect damage and return annotated image along with detection results
+    
+    Clients sending `Accept: multipart/mixed` get the JSON report and the raw
+    JPEG as two parts; otherwise the image is embedded in JSON as base64
     """
     try:
         # Similar to above but also return annotated image
         contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        image_array = np.array(image)
+        image_array = await run_in_threadpool(decode_image, contents)
+        if image_array is None:
+            raise HTTPException(status_code=400, detail="Could not decode image")
         
-        if len(image_array.shape) == 3:
-            image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+        damages = await batcher.detect(image_array, confidence)
         
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as tmp_file:
-            cv2.imwrite(tmp_file.name, image_array)
-            temp_path = tmp_file.name
+        if damages is None:
+            raise HTTPException(status_code=500, detail="Damage detection failed")
         
-        try:
-            damages = detector.detect_damage(temp_path, confidence)
-            
-            if damages is None:
-                raise HTTPException(status_code=500, detail="Damage detection failed")
-            
-            # Generate annotated image
-            annotated_image = detector.visualize_detections(temp_path, damages)
-            
-            # Convert annotated image to base64
-            import base64
-            _, buffer = cv2.imencode('.jpg', annotated_image)
-            img_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            report = detector.generate_report(damages, file.filename)
-            
-            api_response = {
-                "success": True,
-                "filename": file.filename,
-                "confidence_threshold": confidence,
-                "annotated_image": f"data:image/jpeg;base64,{img_base64}",
-                **report
-            }
-            
-            return api_response
-            
-        finally:
-            Path(temp_path).unlink(missing_ok=True)
+        # Generate annotated image
+        jpeg_bytes = await run_in_threadpool(encode_annotated_image, image_array, damages)
+        
+        report = detector.generate_report(damages, file.filename)
+        
+        api_response = {
+            "success": True,
+            "filename": file.filename,
+            "confidence_threshold": confidence,
+            **report
+        }
+        
+        if "multipart/mixed" in accept:
+            return multipart_response(api_response, jpeg_bytes)
+        
+        img_base64 = base64.b64encode(jpeg_bytes).decode('ascii')
+        api_response["annotated_image"] = f"data:image/jpeg;base64,{img_base64}"
+        
+        return api_response
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
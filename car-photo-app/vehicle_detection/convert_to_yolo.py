@@ -6,10 +6,19 @@ Convert VehiDE Dataset to YOLO format for damage detection training
 import os
 import json
 import shutil
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 from pathlib import Path
-import cv2
+import numpy as np
+from PIL import Image
 import pandas as pd
 
+try:
+    import ijson  # Streaming JSON parser (optional)
+except ImportError:
+    ijson = None
+
 class VehiDEToYOLO:
     def __init__(self, dataset_path='./datasets/vehide', output_path='./datasets/yolo_damage'):
         self.dataset_path = Path(dataset_path)
@@ -39,27 +48,24 @@ class VehiDEToYOLO:
         
         print("✅ Directory structure created")
     
-    def convert_bbox_to_yolo(self, bbox, img_width, img_height):
+    @staticmethod
+    def convert_bbox_to_yolo(bboxes, img_width, img_height):
         """
-        Convert bounding box to YOLO format
-        bbox: [x_min, y_min, x_max, y_max] in pixels
-        Returns: [x_center, y_center, width, height] normalized
+        Convert bounding boxes to YOLO format
+        bboxes: (N, 4) array of [x_min, y_min, x_max, y_max] in pixels
+        Returns: (N, 4) array of [x_center, y_center, width, height] normalized
         """
-        x_min, y_min, x_max, y_max = bbox
+        bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+        yolo_bboxes = np.empty_like(bboxes)
         
         # Calculate center and dimensions
-        x_center = (x_min + x_max) / 2.0
-        y_center = (y_min + y_max) / 2.0
-        width = x_max - x_min
-        height = y_max - y_min
+        yolo_bboxes[:, :2] = (bboxes[:, :2] + bboxes[:, 2:]) * 0.5
+        yolo_bboxes[:, 2:] = bboxes[:, 2:] - bboxes[:, :2]
         
         # Normalize by image dimensions
-        x_center /= img_width
-        y_center /= img_height
-        width /= img_width
-        height /= img_height
+        yolo_bboxes /= np.array([img_width, img_height, img_width, img_height], dtype=np.float32)
         
-        return [x_center, y_center, width, height]
+        return yolo_bboxes
     
     def process_annotations(self, annotation_file, image_dir, split='train'):
         """Process annotation file and convert to YOLO format"""
@@ -68,68 +74,51 @@ class VehiDEToYOLO:
         # This will depend on the actual VehiDE annotation format
         # Update this based on the dataset structure
         
-        if annotation_file.suffix == '.json':
-            with open(annotation_file, 'r') as f:
-                annotations = json.load(f)
-        elif annotation_file.suffix == '.csv':
-            annotations = pd.read_csv(annotation_file)
-        else:
+        if annotation_file.suffix not in ('.json', '.csv'):
             print(f"❌ Unsupported annotation format: {annotation_file.suffix}")
             return
         
+        annotations = self.iter_annotations(annotation_file)
+        
         processed_count = 0
+        split_dir = self.output_path / split
+        workers = os.cpu_count()
         
-        # Process each annotation (adapt based on actual format)
-        for annotation in annotations:
-            try:
-                # Extract image info (update field names as needed)
-                image_filename = annotation.get('filename') or annotation.get('image_name')
-                image_path = image_dir / image_filename
+        # Process each annotation in parallel (adapt based on actual format)
+        # Executor.map submits its whole input up front, so feed it bounded
+        # batches to keep memory flat while annotations stream in
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch in batched(annotations, workers * 256):
+                results = executor.map(_convert_one, batch,
+                                       repeat(image_dir), repeat(split_dir), repeat(self.damage_classes),
+                                       chunksize=32)
                 
-                if not image_path.exists():
-                    continue
-                
-                # Read image to get dimensions
-                image = cv2.imread(str(image_path))
-                if image is None:
-                    continue
-                
-                img_height, img_width = image.shape[:2]
-                
-                # Copy image to YOLO structure
-                output_image_path = self.output_path / split / 'images' / image_filename
-                shutil.copy2(image_path, output_image_path)
-                
-                # Process damage annotations
-                label_filename = image_path.stem + '.txt'
-                label_path = self.output_path / split / 'labels' / label_filename
-                
-                with open(label_path, 'w') as label_file:
-                    # Extract damage annotations (update based on actual format)
-                    damages = annotation.get('damages', []) or annotation.get('annotations', [])
+                for converted in results:
+                    if not converted:
+                        continue
                     
-                    for damage in damages:
-                        damage_type = damage.get('type') or damage.get('class')
-                        bbox = damage.get('bbox') or damage.get('bounding_box')
-                        
-                        if damage_type in self.damage_classes and bbox:
-                            class_id = self.damage_classes[damage_type]
-                            yolo_bbox = self.convert_bbox_to_yolo(bbox, img_width, img_height)
-                            
-                            # Write YOLO format: class_id x_center y_center width height
-                            label_file.write(f"{class_id} {' '.join(map(str, yolo_bbox))}\\n")
-                
-                processed_count += 1
-                
-                if processed_count % 100 == 0:
-                    print(f"  📸 Processed {processed_count} images...")
+                    processed_count += 1
                     
-            except Exception as e:
-                print(f"❌ Error processing {annotation}: {e}")
-                continue
+                    if processed_count % 100 == 0:
+                        print(f"  📸 Processed {processed_count} images...")
         
         print(f"✅ Processed {processed_count} images for {split}")
     
+    def iter_annotations(self, annotation_file):
+        """
+        Yield annotation records one at a time without loading the whole file
+        JSON is streamed with ijson when installed; CSV is read in chunks
+        """
+        if annotation_file.suffix == '.csv':
+            for chunk in pd.read_csv(annotation_file, chunksize=10_000):
+                yield from chunk.to_dict('records')
+        elif ijson is not None:
+            with open(annotation_file, 'rb') as f:
+                yield from ijson.items(f, 'item', use_float=True)
+        else:
+            with open(annotation_file, 'r') as f:
+                yield from json.load(f)
+    
     def create_data_yaml(self):
         """Create data.yaml configuration file"""
         print("📄 Creating data.yaml configuration...")
@@ -189,6 +178,170 @@ names: {list(self.damage_classes.keys())}  # class names
         
         return True
 
+def batched(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+# JPEG start-of-frame markers (SOF0-SOF15, minus DHT/JPG/DAC)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def read_exif_orientation(segment):
+    """
+    Read the EXIF orientation tag from an APP1 segment (1 if absent)
+    Returns None for non-EXIF APP1 segments such as XMP
+    """
+    if segment[:6] != b'Exif\x00\x00':
+        return None
+    
+    tiff = segment[6:]
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    
+    for i in range(entry_count):
+        entry = ifd_offset + 2 + 12 * i
+        tag = struct.unpack(endian + 'H', tiff[entry:entry + 2])[0]
+        if tag == 0x0112:
+            return struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])[0]
+    
+    return 1
+
+def read_jpeg_size(image_path):
+    """
+    Read JPEG dimensions from the SOF marker without decoding any pixels
+    Dimensions are swapped for EXIF-rotated images, matching cv2.imread
+    Returns: (width, height), or None if the file isn't a parseable JPEG
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            
+            orientation = 1
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                
+                code = marker[1]
+                while code == 0xFF:  # fill bytes
+                    code = f.read(1)[0]
+                
+                # Standalone markers carry no length field
+                if code == 0x01 or 0xD0 <= code <= 0xD7:
+                    continue
+                if code in (0xD9, 0xDA):  # EOI / SOS before any SOF
+                    return None
+                
+                length = struct.unpack('>H', f.read(2))[0]
+                if code in SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    if orientation >= 5:  # rotated by 90/270 degrees
+                        width, height = height, width
+                    return width, height
+                
+                if code == 0xE1:
+                    exif_orientation = read_exif_orientation(f.read(length - 2))
+                    if exif_orientation is not None:
+                        orientation = exif_orientation
+                else:
+                    f.seek(length - 2, 1)
+    except (OSError, IndexError, struct.error):
+        return None
+
+def read_image_size(image_path):
+    """
+    Get (width, height) from the image header without decoding pixels
+    JPEGs are parsed directly; other formats go through PIL's lazy open
+    """
+    size = read_jpeg_size(image_path)
+    if size is not None:
+        return size
+    
+    try:
+        with Image.open(image_path) as image:
+            img_width, img_height = image.size
+            if image.getexif().get(0x0112, 1) >= 5:  # rotated by 90/270 degrees
+                img_width, img_height = img_height, img_width
+    except OSError:
+        return None
+    
+    return img_width, img_height
+
+def link_image(image_path, output_image_path):
+    """
+    Place an image in the YOLO tree without duplicating its data
+    YOLO only reads images, so a hardlink (same filesystem) or symlink is
+    enough; copyfile is the last resort where links aren't permitted
+    """
+    output_image_path.unlink(missing_ok=True)
+    try:
+        os.link(image_path, output_image_path)
+        return
+    except OSError:
+        pass
+    
+    try:
+        os.symlink(image_path.resolve(), output_image_path)
+    except OSError:
+        shutil.copyfile(image_path, output_image_path)
+
+def _convert_one(annotation, image_dir, split_dir, damage_classes):
+    """
+    Convert a single annotation: copy its image and write its YOLO label file
+    Top-level so it can run in ProcessPoolExecutor workers
+    Returns: True if the image was converted
+    """
+    try:
+        # Extract image info (update field names as needed)
+        image_filename = annotation.get('filename') or annotation.get('image_name')
+        image_path = image_dir / image_filename
+        
+        if not image_path.exists():
+            return False
+        
+        # Read image header to get dimensions
+        size = read_image_size(image_path)
+        if size is None:
+            return False
+        
+        img_width, img_height = size
+        
+        # Link image into YOLO structure
+        output_image_path = split_dir / 'images' / image_filename
+        link_image(image_path, output_image_path)
+        
+        # Process damage annotations
+        label_filename = image_path.stem + '.txt'
+        label_path = split_dir / 'labels' / label_filename
+        
+        # Extract damage annotations (update based on actual format)
+        damages = annotation.get('damages', []) or annotation.get('annotations', [])
+        
+        class_ids = []
+        bboxes = []
+        for damage in damages:
+            damage_type = damage.get('type') or damage.get('class')
+            bbox = damage.get('bbox') or damage.get('bounding_box')
+            
+            if damage_type in damage_classes and bbox:
+                class_ids.append(damage_classes[damage_type])
+                bboxes.append(bbox)
+        
+        yolo_bboxes = VehiDEToYOLO.convert_bbox_to_yolo(bboxes, img_width, img_height)
+        
+        # Write YOLO format: class_id x_center y_center width height
+        np.savetxt(label_path, np.column_stack([class_ids, yolo_bboxes]),
+                   fmt="%d %.6f %.6f %.6f %.6f")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Error processing {annotation}: {e}")
+        return False
+
 if __name__ == "__main__":
     converter = VehiDEToYOLO()
     converter.convert_dataset()
@@ -3,25 +3,115 @@
 Train YOLOv8 model for vehicle damage detection
 """
 
+import argparse
+import json
+import os
+import re
+import tempfile
+import time
 from ultralytics import YOLO
+from ultralytics.utils import DEFAULT_CFG_DICT
+from ultralytics.utils.downloads import attempt_download_asset
 import torch
+import numpy as np
 from pathlib import Path
+import psutil
+import warnings
 import yaml
 
+# libyaml's C loader is ~10x faster than the pure-Python SafeLoader
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+if YAML_LOADER is yaml.SafeLoader:
+    warnings.warn("PyYAML was built without libyaml; falling back to the pure-Python SafeLoader")
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
 class DamageDetectionTrainer:
-    def __init__(self, data_yaml='./datasets/yolo_damage/data.yaml'):
+    def __init__(self, data_yaml='./datasets/yolo_damage/data.yaml', cache_mode=None,
+                 use_dali=False, pad_classes=False, local_rank=None):
+        """
+        cache_mode: True (RAM), 'disk', False, or None to pick automatically
+        use_dali: decode JPEGs on the GPU with NVIDIA DALI into the disk cache
+        pad_classes: train with the class count padded to a multiple of 8
+        local_rank: process rank on this node (defaults to LOCAL_RANK, -1 if unset)
+        """
         self.data_yaml = Path(data_yaml)
+        self.cache_mode = cache_mode
+        self.use_dali = use_dali
+        self.pad_classes = pad_classes
+        if local_rank is None:
+            local_rank = int(os.environ.get('LOCAL_RANK', -1))
+        self.local_rank = local_rank
+        # Under torchrun every rank runs this script; only rank 0 reports
+        self.is_main_process = get_rank(local_rank) in (-1, 0)
+        # Shared with torch.hub so every run (and every DDP rank) reuses one copy
+        self.pretrained_dir = Path(torch.hub.get_dir()) / 'checkpoints'
         self.model_dir = Path('./models')
         self.model_dir.mkdir(exist_ok=True)
         
+    def resolve_pretrained(self, model_name, timeout=600):
+        """
+        Download pre-trained weights once per node into the torch hub cache
+        The hub cache is node-local, so local rank 0 downloads; other ranks
+        wait for the file (at a barrier when a process group exists,
+        otherwise by polling) and then load it instead of racing to fetch it
+        Returns: Local path of the weights
+        """
+        pretrained_path = self.pretrained_dir / model_name
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        
+        if self.local_rank in (-1, 0):
+            if not pretrained_path.exists():
+                self.pretrained_dir.mkdir(parents=True, exist_ok=True)
+                # Download beside the target and rename it into place, so
+                # polling ranks never load a partially written file
+                with tempfile.TemporaryDirectory(dir=self.pretrained_dir) as tmp_dir:
+                    downloaded = attempt_download_asset(Path(tmp_dir) / model_name)
+                    os.replace(downloaded, pretrained_path)
+        elif not distributed and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+            wait_for_file(pretrained_path, timeout)
+        
+        if distributed:
+            torch.distributed.barrier()
+        
+        return pretrained_path
+    
+    def log(self, *lines):
+        """Print on the main process only, so DDP ranks don't repeat output"""
+        if self.is_main_process:
+            print('\n'.join(lines))  # One write, as with the parameter dump
+    
     def check_gpu(self):
-        """Check if GPU is available"""
+        """
+        Check if GPUs are available
+        Returns: Number of CUDA devices (0 for CPU training)
+        """
         if torch.cuda.is_available():
-            print(f"🚀 GPU detected: {torch.cuda.get_device_name()}")
-            return True
+            num_gpus = torch.cuda.device_count()
+            self.log(f"🚀 GPU detected: {torch.cuda.get_device_name()}")
+            if num_gpus > 1:
+                self.log(f"🚀 {num_gpus} GPUs detected, using DistributedDataParallel")
+            return num_gpus
         else:
-            print("💻 Using CPU training (will be slower)")
-            return False
+            self.log("💻 Using CPU training (will be slower)")
+            return 0
+    
+    def enable_tf32(self):
+        """Let FP32 matmuls and convolutions use TF32 Tensor Cores (Ampere+)"""
+        torch.set_float32_matmul_precision('high')
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        # Also applies to the DDP worker processes Ultralytics spawns
+        os.environ.setdefault('TORCH_ALLOW_TF32_CUBLAS_OVERRIDE', '1')
+    
+    def select_device(self, num_gpus):
+        """
+        Ultralytics device argument: a comma-separated GPU list launches
+        DistributedDataParallel (one process per GPU, NCCL backend)
+        """
+        if num_gpus > 1:
+            return ','.join(str(i) for i in range(num_gpus))
+        return 0 if num_gpus == 1 else 'cpu'
     
     def load_config(self):
         """Load dataset configuration"""
@@ -31,48 +121,183 @@ class DamageDetectionTrainer:
             return None
         
         with open(self.data_yaml, 'r') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YAML_LOADER)
+        
+        # cuDNN only picks Tensor Core kernels when channel counts are a
+        # multiple of 8; the detect head's class conv has nc output channels
+        config['nc_padded'] = ((config['nc'] + 7) // 8) * 8
         
-        print(f"📋 Dataset config loaded:")
-        print(f"  Classes: {config['nc']}")
-        print(f"  Damage types: {config['names']}")
+        self.log("📋 Dataset config loaded:",
+                 f"  Classes: {config['nc']}",
+                 f"  Damage types: {config['names']}")
         
         return config
     
+    def write_padded_config(self, config):
+        """
+        Write a copy of data.yaml with placeholder classes up to nc_padded
+        No labels use the placeholders, so they only ever train as background
+        and the real classes keep their ids. Local rank 0 writes the file;
+        other ranks on the node wait for it
+        Returns: Path of the padded data.yaml
+        """
+        # Same directory, so a relative 'path' still resolves to the dataset
+        padded_yaml = self.data_yaml.with_name(f'{self.data_yaml.stem}_padded.yaml')
+        if self.local_rank not in (-1, 0):
+            wait_for_file(padded_yaml)
+            return padded_yaml
+        
+        names = config['names']
+        if isinstance(names, dict):
+            names = [names[i] for i in sorted(names)]
+        
+        padded = {k: v for k, v in config.items() if k != 'nc_padded'}
+        padded['names'] = list(names) + [f'_pad{i}' for i in range(len(names), config['nc_padded'])]
+        padded['nc'] = config['nc_padded']
+        
+        # Written aside and renamed so waiting ranks never read a partial file
+        partial_yaml = padded_yaml.with_suffix('.yaml.partial')
+        with open(partial_yaml, 'w') as f:
+            yaml.safe_dump(padded, f, sort_keys=False)
+        os.replace(partial_yaml, padded_yaml)
+        
+        self.log(f"📐 Padded classes {config['nc']} -> {config['nc_padded']}: {padded_yaml}")
+        return padded_yaml
+    
+    def split_dir(self, config, split):
+        """Resolve a dataset split's image directory from data.yaml"""
+        dataset_root = Path(config.get('path', self.data_yaml.parent))
+        if not dataset_root.is_absolute():
+            dataset_root = self.data_yaml.parent / dataset_root
+        return dataset_root / config[split]
+    
+    def predecode_with_dali(self, image_dir, batch_size=64):
+        """
+        Decode JPEGs on the GPU with NVIDIA DALI (nvJPEG) and save them as the
+        .npy files Ultralytics loads in place of the JPEG (in every cache
+        mode), so dataloader workers never decode JPEGs on the CPU
+        Returns: True if the .npy files were written
+        """
+        try:
+            from nvidia.dali import fn, pipeline_def, types
+        except ImportError:
+            print("⚠️  NVIDIA DALI not installed, decoding on CPU workers")
+            return False
+        
+        files = sorted(f for f in Path(image_dir).rglob('*')
+                       if f.suffix.lower() in ('.jpg', '.jpeg') and not f.with_suffix('.npy').exists())
+        if not files:
+            return True
+        
+        @pipeline_def(batch_size=batch_size, num_threads=4, device_id=0)
+        def decode_pipeline():
+            jpegs, _ = fn.readers.file(files=[str(f) for f in files], name='reader')
+            # BGR to match the cv2.imread arrays Ultralytics caches itself
+            return fn.decoders.image(jpegs, device='mixed', output_type=types.BGR)
+        
+        self.log(f"⚡ Decoding {len(files)} images on GPU with DALI: {image_dir}")
+        pipe = decode_pipeline()
+        pipe.build()
+        
+        for start in range(0, len(files), batch_size):
+            (images,) = pipe.run()
+            images = images.as_cpu()
+            # The last batch is padded with wrapped-around samples; skip those.
+            # Files are renamed into place since other ranks may be reading them
+            for i, image_file in enumerate(files[start:start + batch_size]):
+                partial_file = image_file.with_suffix('.partial.npy')
+                np.save(partial_file, np.array(images.at(i)), allow_pickle=False)
+                os.replace(partial_file, image_file.with_suffix('.npy'))
+        
+        return True
+    
+    def select_cache_mode(self, config, img_size, num_gpus=0):
+        """
+        Cache decoded images in RAM when they fit in half the available memory,
+        otherwise as .npy files on disk so later epochs skip JPEG decoding
+        """
+        if self.cache_mode is not None:
+            return self.cache_mode
+        
+        def count_images(split):
+            split_dir = self.split_dir(config, split)
+            return sum(1 for f in split_dir.rglob('*') if f.suffix.lower() in IMAGE_SUFFIXES)
+        
+        num_train, num_val = count_images('train'), count_images('val')
+        
+        # Ultralytics caches images resized to img_size, 3 bytes per pixel.
+        # Every DDP rank caches the full train set; rank 0 also caches val
+        image_bytes = img_size * img_size * 3
+        cache_bytes = (num_train * max(1, num_gpus) + num_val) * image_bytes
+        available = psutil.virtual_memory().available
+        
+        cache_mode = True if cache_bytes < available * 0.5 else 'disk'
+        self.log(f"💾 Image cache: {'RAM' if cache_mode is True else 'disk'} "
+                 f"({cache_bytes / 1e9:.1f} GB for {num_train} train + {num_val} val images "
+                 f"on {max(1, num_gpus)} rank(s), {available / 1e9:.1f} GB RAM available)")
+        
+        return cache_mode
+    
     def train_model(self, 
                    model_size='n',  # n, s, m, l, x
                    epochs=100,
-                   batch_size=16,
-                   img_size=640):
+                   batch_size=-1,  # -1: AutoBatch to ~60% of GPU memory
+                   img_size=640,
+                   save_period=-1):  # -1: keep only best.pt and last.pt
         """Train YOLOv8 model for damage detection"""
         
-        print("🚗 Training YOLOv8 for Vehicle Damage Detection")
-        print("=" * 50)
+        self.log("🚗 Training YOLOv8 for Vehicle Damage Detection", "=" * 50)
         
         # Check prerequisites
         config = self.load_config()
         if not config:
             return False
         
-        self.check_gpu()
+        # QAT and export reuse self.data_yaml, so they see the same head size
+        if self.pad_classes and config['nc_padded'] != config['nc']:
+            self.data_yaml = self.write_padded_config(config)
+        
+        num_gpus = self.check_gpu()
+        if num_gpus:
+            self.enable_tf32()
         
         # Load pre-trained model
         model_name = f'yolov8{model_size}.pt'
-        print(f"📥 Loading pre-trained model: {model_name}")
-        model = YOLO(model_name)
+        pretrained_path = self.resolve_pretrained(model_name)
+        self.log(f"📥 Loading pre-trained model: {pretrained_path}")
+        model = YOLO(str(pretrained_path))
+        
+        # NHWC convolutions hit cuDNN's Tensor Core kernels without transposes.
+        # DDP registers gradient buckets before the callback runs, so only
+        # single-GPU training switches memory format
+        if num_gpus == 1 and torch.backends.cudnn.version() >= 8000:
+            model.add_callback('on_pretrain_routine_end', use_channels_last)
+        
+        cache_mode = self.select_cache_mode(config, img_size, num_gpus)
+        # One decode per node; other ranks read whichever .npy files exist
+        if self.use_dali and num_gpus and self.local_rank in (-1, 0):
+            for split in ('train', 'val'):
+                self.predecode_with_dali(self.split_dir(config, split))
+        
+        # AutoBatch only works on a single GPU; DDP splits a fixed total batch
+        if batch_size < 1 and num_gpus > 1:
+            batch_size = 16 * num_gpus
         
         # Training parameters
         train_params = {
             'data': str(self.data_yaml),
             'epochs': epochs,
             'batch': batch_size,
+            'nbs': 64,          # Nominal batch: gradients accumulate to 64 images per step
             'imgsz': img_size,
             'project': str(self.model_dir),
             'name': 'damage_detection',
-            'save_period': 10,  # Save checkpoint every 10 epochs
+            'save_period': save_period,  # Extra epoch checkpoints stall every rank on slow storage
             'patience': 50,     # Early stopping patience
-            'cache': True,      # Cache images for faster training
-            'device': 0 if torch.cuda.is_available() else 'cpu',
+            'cache': cache_mode,  # RAM or disk image cache
+            'workers': max(4, os.cpu_count() // max(1, num_gpus)),  # Per-GPU loader workers
+            'device': self.select_device(num_gpus),
+            'amp': num_gpus > 0,  # Mixed precision (FP16 Tensor Cores) on GPU only
             
             # Data augmentation
             'hsv_h': 0.015,
@@ -89,16 +314,41 @@ class DamageDetectionTrainer:
             'mixup': 0.0,
         }
         
-        print(f"🔧 Training parameters:")
-        for key, value in train_params.items():
-            print(f"  {key}: {value}")
+        # torch.compile (Inductor) fuses Conv-BN-SiLU into single kernels.
+        # Only Ultralytics versions with a 'compile' arg handle the compiled
+        # wrapper in EMA and checkpointing, so older versions train eagerly
+        if num_gpus and 'compile' in DEFAULT_CFG_DICT:
+            train_params['compile'] = True
+        elif num_gpus:
+            self.log("ℹ️  This Ultralytics version has no 'compile' option, training eagerly")
+        
+        # Training batches are imgsz x imgsz, so cuDNN can benchmark conv
+        # algorithms once and reuse the fastest. This only checks the train
+        # settings above (rect/multi_scale would re-benchmark every step); the
+        # rect-shaped validation batches still get benchmarked once per shape.
+        # The flag is per-process: the DDP workers Ultralytics spawns for
+        # multi-GPU runs start fresh interpreters and keep cuDNN's heuristics
+        static_shapes = not (train_params.get('rect') or train_params.get('multi_scale'))
+        torch.backends.cudnn.benchmark = static_shapes
+        if num_gpus > 1 and self.local_rank == -1:
+            self.log("ℹ️  cudnn.benchmark does not reach Ultralytics' DDP workers")
+        if num_gpus and static_shapes:
+            train_params['deterministic'] = False  # Deterministic mode pins slower algorithms
+        
+        self.log("🔧 Training parameters:",
+                 *(f"  {key}: {value}" for key, value in train_params.items()))
+        
+        enable_loader_prefetch()
         
-        print("\\n🚀 Starting training...")
+        self.log("\\n🚀 Starting training...")
         
         try:
             # Train the model
             results = model.train(**train_params)
             
+            if not self.is_main_process:
+                return True
+            
             print("\\n✅ Training completed!")
             
             # Model paths
@@ -122,8 +372,191 @@ class DamageDetectionTrainer:
             print(f"❌ Training failed: {e}")
             return False
     
-    def export_model(self, model_path=None, formats=['onnx', 'tflite']):
-        """Export trained model to different formats"""
+    def qat_finetune(self, best_pt=None, epochs=5, img_size=640, calib_batches=32):
+        """
+        Quantization-aware finetune of the trained model before export
+        Fake-quant nodes are inserted into every convolution so the weights
+        adapt to INT8 rounding; the exported ONNX carries Q/DQ nodes that
+        TensorRT builds into a pure INT8 engine
+        Returns: Path of the Q/DQ ONNX model, or None if skipped
+        """
+        try:
+            from pytorch_quantization import nn as quant_nn
+            from pytorch_quantization import quant_modules
+        except ImportError:
+            print("⚠️  pytorch-quantization not installed, skipping QAT finetune")
+            return None
+        
+        if not best_pt:
+            best_pt = self.model_dir / 'damage_detection' / 'weights' / 'best.pt'
+        
+        if not Path(best_pt).exists():
+            print(f"❌ Model not found: {best_pt}")
+            return None
+        
+        print(f"🎯 QAT finetune: {best_pt} ({epochs} epochs)")
+        
+        def calibrate_quantizers(trainer):
+            """Collect static activation ranges before the first QAT epoch"""
+            quantizers = [m for m in trainer.model.modules() if isinstance(m, quant_nn.TensorQuantizer)]
+            for quantizer in quantizers:
+                if quantizer._calibrator is not None:
+                    quantizer.disable_quant()
+                    quantizer.enable_calib()
+                else:
+                    quantizer.disable()
+            
+            # Eval mode so calibration batches don't update BatchNorm running stats
+            trainer.model.eval()
+            try:
+                with torch.no_grad():
+                    for i, batch in enumerate(trainer.train_loader):
+                        trainer.model(batch['img'].to(trainer.device).float() / 255)
+                        if i + 1 >= calib_batches:
+                            break
+            finally:
+                trainer.model.train()
+            
+            for quantizer in quantizers:
+                if quantizer._calibrator is not None:
+                    quantizer.load_calib_amax()
+                    quantizer.disable_calib()
+                    quantizer.enable_quant()
+                else:
+                    quantizer.enable()
+        
+        # Models built from here on use QuantConv2d in place of Conv2d;
+        # Ultralytics rebuilds the model from its yaml when training starts
+        quant_modules.initialize()
+        try:
+            model = YOLO(str(best_pt))
+            model.add_callback('on_pretrain_routine_end', calibrate_quantizers)
+            model.train(
+                data=str(self.data_yaml),
+                epochs=epochs,
+                imgsz=img_size,
+                lr0=1e-4,
+                amp=False,  # Fake quantization needs FP32 ranges
+                project=str(self.model_dir),
+                name='damage_detection_qat',
+                exist_ok=True,
+            )
+        finally:
+            quant_modules.deactivate()
+        
+        # Ultralytics' exporter fuses Conv+BN into fresh Conv2d layers, which
+        # would drop the quantizers, so the unfused graph is exported directly
+        net = model.model.float().eval().cpu()
+        for module in net.modules():
+            if module.__class__.__name__ == 'Detect':
+                module.export = True
+                module.format = 'onnx'
+        
+        onnx_path = self.model_dir / 'damage_detection_qat' / 'weights' / 'best_qat.onnx'
+        # Emit QuantizeLinear/DequantizeLinear nodes instead of custom ops
+        quant_nn.TensorQuantizer.use_fb_fake_quant = True
+        try:
+            torch.onnx.export(
+                net,
+                torch.zeros(1, 3, img_size, img_size),
+                str(onnx_path),
+                opset_version=13,  # Per-channel Q/DQ
+                input_names=['images'],
+                output_names=['output0'],
+            )
+        finally:
+            quant_nn.TensorQuantizer.use_fb_fake_quant = False
+        
+        print(f"✅ QAT model exported: {onnx_path}")
+        return onnx_path
+    
+    def export_int8_engine(self, model, model_path, img_size=640, calib_images=500, workspace=4,
+                           qat_onnx=None):
+        """
+        Build an INT8 TensorRT engine
+        With a QAT model the Q/DQ nodes in qat_onnx carry the INT8 scales
+        (explicit quantization, no calibrator). Otherwise the engine is
+        calibrated post-training and quantization-sensitive layers (the first
+        two convolutions and the detect head) stay in FP16, since naive
+        full-INT8 YOLOv8 engines lose most of their detections
+        Returns: Path of the engine, named like inference.py's INT8 engine
+        """
+        import tensorrt as trt
+        
+        model_path = Path(model_path)
+        engine_path = model_path.with_name(f"{model_path.stem}_int8_b1.engine")
+        cache_file = model_path.with_name(f"{model_path.stem}_int8.cache")
+        
+        if qat_onnx:
+            onnx_path = Path(qat_onnx)
+        else:
+            # FP32 ONNX graph as the builder input, kept apart from the deployable best.onnx
+            onnx_path = Path(model.export(format='onnx', imgsz=img_size, simplify=True, dynamic=False))
+            onnx_path = onnx_path.replace(model_path.with_name(f"{model_path.stem}_int8_build.onnx"))
+        
+        logger = trt.Logger(trt.Logger.WARNING)
+        builder = trt.Builder(logger)
+        network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, logger)
+        if not parser.parse_from_file(str(onnx_path)):
+            errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+            raise RuntimeError(f"Failed to parse {onnx_path}: {errors}")
+        
+        config = builder.create_builder_config()
+        config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, workspace << 30)
+        config.set_flag(trt.BuilderFlag.INT8)
+        config.set_flag(trt.BuilderFlag.FP16)  # Layers outside Q/DQ pairs run in FP16
+        
+        if qat_onnx:
+            print(f"  🎯 Explicit quantization from {onnx_path}")
+        else:
+            config.set_flag(trt.BuilderFlag.OBEY_PRECISION_CONSTRAINTS)
+            
+            val_dir = self.split_dir(self.load_config(), 'val')
+            images = sorted(f for f in val_dir.rglob('*') if f.suffix.lower() in IMAGE_SUFFIXES)
+            config.int8_calibrator = build_entropy_calibrator(trt, images[:calib_images], img_size, cache_file)
+            
+            # ONNX layer names follow the module path, e.g. /model.0/conv/Conv;
+            # the detect head is the last module (model.22 for YOLOv8)
+            head_index = len(model.model.model) - 1
+            sensitive = re.compile(rf"^/model\.(0|1|{head_index})/")
+            fp16_layers = 0
+            for i in range(network.num_layers):
+                layer = network.get_layer(i)
+                outputs = [layer.get_output(j) for j in range(layer.num_outputs)]
+                # Shape and index layers must keep their integer types
+                if not sensitive.match(layer.name) or any(o.dtype != trt.float32 for o in outputs):
+                    continue
+                layer.precision = trt.float16
+                for j in range(layer.num_outputs):
+                    layer.set_output_type(j, trt.float16)
+                fp16_layers += 1
+            print(f"  🎯 Keeping {fp16_layers} sensitive layers in FP16")
+        
+        serialized_engine = builder.build_serialized_network(network, config)
+        if serialized_engine is None:
+            raise RuntimeError("TensorRT engine build failed")
+        
+        # Prefix Ultralytics metadata so YOLO(engine_path) loads it like its own exports
+        metadata = json.dumps({
+            'task': 'detect',
+            'stride': int(max(model.model.stride)),
+            'batch': 1,
+            'imgsz': [img_size, img_size],
+            'names': model.names,
+        }).encode()
+        with open(engine_path, 'wb') as f:
+            f.write(len(metadata).to_bytes(4, byteorder='little', signed=True))
+            f.write(metadata)
+            f.write(serialized_engine)
+        
+        return engine_path
+    
+    def export_model(self, model_path=None, formats=['onnx', 'tflite', 'engine'], qat_onnx=None):
+        """
+        Export trained model to different formats
+        qat_onnx: Q/DQ ONNX from qat_finetune to build the INT8 engine from
+        """
         if not model_path:
             model_path = self.model_dir / 'damage_detection' / 'weights' / 'best.pt'
         
@@ -134,33 +567,165 @@ class DamageDetectionTrainer:
         print(f"📦 Exporting model: {model_path}")
         model = YOLO(model_path)
         
+        # The engine build exports its own FP32 ONNX; run it before the
+        # deployable ONNX export so that one isn't overwritten. Formats run
+        # sequentially: tracing and the converters are GIL-bound, and the
+        # GPU exports and TensorRT build would contend for the same device
+        order = {'engine': 0, 'onnx': 1}
+        formats = sorted(formats, key=lambda f: order.get(f, 2))
+        
+        print(f"  🔄 Exporting to {', '.join(formats)}...")
+        results = []
         for format_type in formats:
             try:
-                print(f"  🔄 Exporting to {format_type}...")
-                model.export(format=format_type)
-                print(f"  ✅ {format_type} export completed")
+                if format_type == 'engine':
+                    if not torch.cuda.is_available():
+                        results.append("  ⚠️  Skipping engine export (TensorRT needs a CUDA GPU)")
+                        continue
+                    self.export_int8_engine(model, model_path, qat_onnx=qat_onnx)
+                elif format_type == 'onnx':
+                    # Match the FP16 training precision for GPU runtimes; the
+                    # exporter only honours half=True when it runs on a GPU
+                    gpu = torch.cuda.is_available()
+                    model.export(format='onnx', half=gpu, device=0 if gpu else 'cpu', simplify=True)
+                elif format_type == 'tflite':
+                    # Full-integer TFLite for mobile, calibrated on the dataset
+                    model.export(format='tflite', int8=True, data=str(self.data_yaml))
+                else:
+                    model.export(format=format_type)
+                results.append(f"  ✅ {format_type} export completed")
             except Exception as e:
-                print(f"  ❌ {format_type} export failed: {e}")
+                results.append(f"  ❌ {format_type} export failed: {e}")
         
+        print('\n'.join(results))
         return True
 
+def build_entropy_calibrator(trt, images, img_size, cache_file):
+    """
+    TensorRT entropy calibrator over letterboxed images (batch size 1)
+    The calibration table is cached so rebuilding the engine skips calibration
+    """
+    import cv2
+    
+    class EntropyCalibrator(trt.IInt8EntropyCalibrator2):
+        def __init__(self):
+            super().__init__()
+            self.index = 0
+            self.device_input = None
+        
+        def get_batch_size(self):
+            return 1
+        
+        def get_batch(self, names):
+            while self.index < len(images):
+                image = cv2.imread(str(images[self.index]))
+                self.index += 1
+                if image is None:
+                    continue
+                
+                # Same letterbox + RGB/CHW/0-1 layout the exported graph expects
+                height, width = image.shape[:2]
+                ratio = min(img_size / height, img_size / width)
+                new_width, new_height = round(width * ratio), round(height * ratio)
+                pad_x, pad_y = (img_size - new_width) // 2, (img_size - new_height) // 2
+                canvas = np.full((img_size, img_size, 3), 114, dtype=np.uint8)
+                canvas[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = cv2.resize(
+                    image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+                tensor = canvas[..., ::-1].transpose(2, 0, 1)[None].astype(np.float32) / 255
+                
+                self.device_input = torch.from_numpy(tensor).cuda()
+                return [int(self.device_input.data_ptr())]
+            
+            return None
+        
+        def read_calibration_cache(self):
+            if cache_file.exists():
+                return cache_file.read_bytes()
+            return None
+        
+        def write_calibration_cache(self, cache):
+            cache_file.write_bytes(cache)
+    
+    return EntropyCalibrator()
+
+def enable_loader_prefetch(prefetch_factor=4):
+    """
+    Make Ultralytics' dataloaders prefetch deeper per worker
+    Ultralytics doesn't expose this DataLoader flag, so its loader class is
+    patched in place; pin_memory is already on by default (PIN_MEMORY env).
+    Workers already live for the whole run: InfiniteDataLoader keeps a single
+    iterator over a repeating sampler, and persistent_workers would leak the
+    old workers whenever reset() builds a new iterator (at close_mosaic)
+    """
+    from ultralytics.data import build
+    
+    original_init = build.InfiniteDataLoader.__init__
+    if getattr(original_init, 'prefetch_patched', False):
+        return
+    
+    def __init__(self, *args, **kwargs):
+        # Only valid with worker processes
+        if kwargs.get('num_workers', 0) > 0:
+            kwargs.setdefault('prefetch_factor', prefetch_factor)
+        original_init(self, *args, **kwargs)
+    
+    __init__.prefetch_patched = True
+    build.InfiniteDataLoader.__init__ = __init__
+
+def use_channels_last(trainer):
+    """
+    Ultralytics callback: convert the training model to channels-last
+    Activations follow the weights' memory format, so NCHW batches are
+    converted once at the first convolution and stay NHWC after that
+    """
+    trainer.model.to(memory_format=torch.channels_last)
+
+def wait_for_file(path, timeout=600):
+    """Poll until another process has written path (renamed into place)"""
+    deadline = time.monotonic() + timeout
+    while not Path(path).exists() and time.monotonic() < deadline:
+        time.sleep(1)
+    if not Path(path).exists():
+        print(f"⚠️  Timed out waiting for {path}")
+    return path
+
+def get_rank(local_rank=-1):
+    """Global process rank under torchrun/DDP (-1 when not distributed)"""
+    return int(os.environ.get('RANK', local_rank))
+
 def main():
-    trainer = DamageDetectionTrainer()
+    parser = argparse.ArgumentParser(description='Vehicle Damage Detection Training')
+    # Passed by torch.distributed.launch; torchrun sets LOCAL_RANK/RANK instead
+    parser.add_argument('--local-rank', '--local_rank', type=int,
+                        default=int(os.environ.get('LOCAL_RANK', -1)),
+                        help='Local process rank for distributed training')
+    args = parser.parse_args()
+    
+    is_main_process = get_rank(args.local_rank) in (-1, 0)
+    
+    trainer = DamageDetectionTrainer(local_rank=args.local_rank)
     
-    print("🚗 Vehicle Damage Detection Training Pipeline")
-    print("=" * 50)
+    if is_main_process:
+        print("🚗 Vehicle Damage Detection Training Pipeline")
+        print("=" * 50)
     
     # Train model
     success = trainer.train_model(
         model_size='n',     # Start with nano for faster training
         epochs=100,         # Adjust based on your needs
-        batch_size=16,      # Adjust based on your GPU memory
+        batch_size=-1,      # Auto-size to GPU memory (or set a fixed size)
         img_size=640        # Standard size for YOLO
     )
     
+    if not is_main_process:
+        return
+    
     if success:
+        print("\\n🎯 Quantization-aware finetuning...")
+        qat_onnx = trainer.qat_finetune()
+        
         print("\\n📦 Exporting model for deployment...")
-        trainer.export_model(formats=['onnx', 'tflite'])
+        trainer.export_model(formats=['onnx', 'tflite', 'engine'], qat_onnx=qat_onnx)
         
         print("\\n🎉 Training pipeline completed!")
         print("🔍 Next step: python inference.py --image path/to/damaged_car.jpg")